@@ -1,24 +1,113 @@
 import os
 import re
 from base64 import b64encode
-from urllib.parse import urlparse, urlunparse, parse_qs, urlencode
+from collections import deque
+from collections.abc import Iterable
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+from urllib.parse import urlparse, urlunparse, parse_qs
 
 from hammock import Hammock
 
+try:
+    from orjson import loads as _loads
+except ImportError:
+    from json import loads as _loads
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
 
 ENVVARS = {
     'url': 'GLPI_URL',
     'app_token': 'GLPI_APP_TOKEN',
     'user_token': 'GLPI_USER_TOKEN',
+    'range_length': 'GLPI_RANGE_LENGTH',
 }
 
+_CONTENT_RANGE_RE = re.compile(r'^(?P<start>\d+)-(?P<end>\d+)/(?P<total>\d+)$')
+
+
+def _content_range(response):
+    """
+    Parse the Content-Range header of a response into start, end and total
+
+    >>> from requests import Response
+    >>> response = Response()
+    >>> response.headers['Content-Range'] = '50-99/250'
+    >>> _content_range(response)
+    (50, 99, 250)
+    """
+    currange = _CONTENT_RANGE_RE.match(response.headers['Content-Range'])
+    return tuple(int(currange.group(x)) for x in ('start', 'end', 'total'))
+
+
+def _parse_range_length(value, name):
+    """
+    Validate a range length given as an argument or environment variable
+
+    >>> _parse_range_length('100', 'GLPI_RANGE_LENGTH')
+    100
+    >>> _parse_range_length('-100', 'GLPI_RANGE_LENGTH')
+    Traceback (most recent call last):
+    ...
+    RuntimeError: GLPI_RANGE_LENGTH must be a positive integer, not '-100'
+    """
+    try:
+        length = int(value)
+    except (TypeError, ValueError):
+        length = 0
+    if length <= 0:
+        raise RuntimeError(
+            '%s must be a positive integer, not %r' % (name, value)
+        )
+    return length
+
+
+def _close_result(future):
+    if not future.cancelled() and future.exception() is None:
+        future.result().close()
+
+
+def _discard(future):
+    """
+    Cancel a pending request, or close its response once it was received
+    """
+    if not future.cancel():
+        future.add_done_callback(_close_result)
+
 
 class APIError(Exception):
+    """
+    Error returned by the GLPI API
+
+    >>> import pickle
+    >>> error = APIError(url='url', response_code='ERROR', response_text='text')
+    >>> error = pickle.loads(pickle.dumps(error))
+    >>> error
+    APIError(url='url', response_code='ERROR')
+    >>> error.response_text
+    'text'
+    """
+
+    __slots__ = ('url', 'response_code', 'response_text')
+
     def __init__(self, url, response_code, response_text=None):
         self.url = url
         self.response_code = response_code
         self.response_text = response_text
 
+    def __reduce__(self):
+        # slots are not part of the pickled state of exceptions, and only
+        # positional arguments end up in args
+        return self.__class__, (
+            self.url,
+            self.response_code,
+            self.response_text,
+        )
+
     def __repr__(self):
         return '%s(url=%r, response_code=%r)' % (
             self.__class__.__name__,
@@ -34,6 +123,18 @@ class APIError(Exception):
         )
 
 
+def _basic_auth(credentials):
+    """
+    Build the Authorization header value for login via user credentials
+
+    >>> _basic_auth(('glpi', 'glpi'))
+    'Basic Z2xwaTpnbHBp'
+    >>> _basic_auth(('jürgen', 'pässword'))
+    'Basic asO8cmdlbjpww6Rzc3dvcmQ='
+    """
+    return 'Basic %s' % b64encode(':'.join(credentials).encode()).decode('ascii')
+
+
 def _resolve_field(k, v, rev):
     """
     Translate a field name to its search option number if not a number already
@@ -49,8 +150,10 @@ def _resolve_field(k, v, rev):
             return v
         else:
             return rev[v]
-    else:
+    elif isinstance(v, (list, tuple)):
         return _resolve_fields(v, rev)
+    else:
+        return v
 
 
 def _resolve_fields(criteria, rev):
@@ -61,6 +164,9 @@ def _resolve_fields(criteria, rev):
     >>> search_options = {1: {'uid': 'Computer.name'}}
     >>> _resolve_fields(criteria, _reverse_search_options(search_options))
     [{'field': 1, 'value': 'name'}]
+    >>> criteria = [{'link': 'AND', 'criteria': [{'field': 'Computer.name'}]}]
+    >>> _resolve_fields(criteria, _reverse_search_options(search_options))
+    [{'link': 'AND', 'criteria': [{'field': 1}]}]
 
     :param criteria: A list of search criterion objects as defined by the GLPI
                      API, except that the values of "field" keys are field UIDs
@@ -72,39 +178,66 @@ def _resolve_fields(criteria, rev):
     :returns: The list of criterion objects with each field UID replaced by its
               search option ID
     """
-    if criteria == "":
+    if not isinstance(criteria, (list, tuple)):
         return criteria
 
-    try:
-        return [
-            {
-                k: _resolve_field(k, v, rev) for k, v in it.items()
-            } for it in criteria
-        ]
-    except (TypeError, AttributeError):
-        return criteria
+    return [
+        {
+            k: _resolve_field(k, v, rev) for k, v in it.items()
+        } if isinstance(it, dict) else it
+        for it in criteria
+    ]
 
 
 def _reverse_search_options(search_options):
     """
     Reverse the search_options to map a UID to its numeric version
 
-    >>> search_options = {1: {'uid': 'Computer.name'}}
+    >>> search_options = {1: {'uid': 'Computer.name'}, 'common': 'Name'}
     >>> _reverse_search_options(search_options)
     {'Computer.name': 1, 'name': 1, 1: 1}
     """
     rev = {}
     for k, v in search_options.items():
-        try:
-            rev[v['uid']] = k
-            rev[v['uid'].split('.', 1)[1]] = k
-            rev[k] = k
-        except (KeyError, TypeError):
-            pass
+        if not isinstance(v, dict) or 'uid' not in v:
+            continue
+        rev[v['uid']] = k
+        rev[_strip_prefix(v['uid'])] = k
+        rev[k] = k
 
     return rev
 
 
+def _strip_prefix(uid):
+    """
+    Strip the itemtype from a field UID
+
+    >>> _strip_prefix('Computer.name')
+    'name'
+    >>> _strip_prefix('Computer.Entity.completename')
+    'Entity.completename'
+    >>> _strip_prefix('name')
+    'name'
+    """
+    head, sep, tail = uid.partition('.')
+    return tail if head and sep else uid
+
+
+def _result_keys(search_options):
+    """
+    Map the keys of search results to the UIDs stripped of their itemtype
+
+    >>> search_options = {'1': {'uid': 'Computer.name'}, 'common': 'Name'}
+    >>> _result_keys(search_options)
+    {'1': 'name'}
+    """
+    return {
+        k: _strip_prefix(v.get('uid', k))
+        for k, v in search_options.items()
+        if isinstance(v, dict)
+    }
+
+
 def build_qs(d, prefix=None):
     """
     Translate nested dict of query string parameters into PHP style query
@@ -112,21 +245,90 @@ def build_qs(d, prefix=None):
 
     >>> list(build_qs({'arr': {'foo': 'bar', 'key': [1, 2]}}))
     [('arr[foo]', 'bar'), ('arr[key][0]', 1), ('arr[key][1]', 2)]
+    >>> list(build_qs([{'field': 1, 'criteria': [{'field': 2}]}], 'criteria'))
+    [('criteria[0][field]', 1), ('criteria[0][criteria][0][field]', 2)]
     """
-    if isinstance(d, str):
-        yield (prefix, d)
-    elif hasattr(d, 'items'):
-        for k, v in d.items():
-            yield from build_qs(v, k if prefix is None else '%s[%s]' % (prefix, k))
-    else:
-        try:
-            for i, v in enumerate(d):
-                yield from build_qs(v, '%s[%d]' % (prefix, i))
-        except TypeError:
+    stack = [(prefix, d)]
+    while stack:
+        prefix, d = stack.pop()
+        if isinstance(d, str):
+            yield (prefix, d)
+        elif hasattr(d, 'items'):
+            # push in reverse so that items are popped in their original order
+            stack.extend(reversed([
+                (k if prefix is None else f'{prefix}[{k}]', v)
+                for k, v in d.items()
+            ]))
+        elif isinstance(d, Iterable):
+            stack.extend(reversed([
+                (f'{prefix}[{i}]', v) for i, v in enumerate(d)
+            ]))
+        else:
             yield (prefix, d)
 
 
-def search(glpi, itemtype, criteria, search_options=None, **kwargs):
+def _translations(glpi, itemtype, search_options=None):
+    """
+    Get the reversed search options and the result key map
+
+    They are only cached on `glpi` for the search options of `itemtype`, as
+    passed in search options may be changed by the caller.
+
+    :param glpi: Instance of `GLPI`
+    :param itemtype: Type of GLPI item to fetch the search options for if
+                     `search_options` is not given
+    :param search_options: Pre-fetched list of search options
+    :returns: Tuple of the result of _reverse_search_options() and
+              _result_keys() for the search options
+    """
+    if search_options:
+        return (
+            _reverse_search_options(search_options),
+            _result_keys(search_options),
+        )
+
+    try:
+        return glpi._reverse_cache[itemtype]
+    except KeyError:
+        pass
+
+    search_options = glpi._search_options_cache.get(itemtype)
+    if search_options is None:
+        search_options = _loads(
+            glpi.listSearchOptions(itemtype).GET().content
+        )
+        glpi._search_options_cache[itemtype] = search_options
+
+    translations = glpi._reverse_cache[itemtype] = (
+        _reverse_search_options(search_options),
+        _result_keys(search_options),
+    )
+    return translations
+
+
+class _LazyRev:
+    """
+    Reversed search options of an itemtype that are only fetched once a field
+    UID has to be translated
+
+    >>> rev = _LazyRev(None, 'Computer')
+    >>> _resolve_fields([{'field': 1, 'value': 'name'}], rev)
+    [{'field': 1, 'value': 'name'}]
+    """
+
+    def __init__(self, glpi, itemtype):
+        self._glpi = glpi
+        self._itemtype = itemtype
+        self._rev = None
+
+    def __getitem__(self, key):
+        if self._rev is None:
+            self._rev, _ = _translations(self._glpi, self._itemtype)
+        return self._rev[key]
+
+
+def search(glpi, itemtype, criteria, search_options=None, stream=False,
+           **kwargs):
     """
     Wrapper around the GLPI search API
 
@@ -136,34 +338,79 @@ def search(glpi, itemtype, criteria, search_options=None, **kwargs):
     :param criteria: List of GLPI search criterion objects according to API,
                      where fields can be given by search option ID or field UID
                      as given in `search_options`
-    :param search_options: Pre-fetched list of search options (useful for
-                           caching or if itemtype=AllAssets)
+    :param search_options: Pre-fetched list of search options (useful if
+                           itemtype=AllAssets). If not given, the search
+                           options of `itemtype` are fetched once and cached
+                           on `glpi`. If "lazy", they are only fetched if a
+                           field UID has to be translated, and the result
+                           keys are returned by the API via `uid_cols`
+    :param stream: Parse the results incrementally while they are received
+                   instead of loading each range completely into memory
+                   (requires ijson)
     :param **kwargs: All other keyword options are passed to the search API
                      endpoint
     :returns: Generator of all search results with keys translated back
               according to `search_options`
     """
-    if not search_options:
-        search_options = glpi.listSearchOptions(itemtype).GET().json()
-    rev_search_options = _reverse_search_options(search_options)
+    if stream and ijson is None:
+        raise RuntimeError('Streaming search results requires ijson')
+
+    itemtype_options = not search_options or search_options == 'lazy'
+    if search_options == 'lazy' and itemtype not in glpi._search_options_cache:
+        rev_search_options = _LazyRev(glpi, itemtype)
+        # let the API return UIDs instead of search option IDs as keys
+        key_map = {}
+        kwargs.setdefault('uid_cols', 'true')
+    else:
+        if search_options == 'lazy':
+            search_options = None
+        rev_search_options, key_map = _translations(
+            glpi, itemtype, search_options
+        )
     criteria = _resolve_fields(criteria, rev_search_options)
     params = dict(build_qs(criteria, 'criteria'))
     params.update(kwargs)
     if 'forcedisplay' in params:
-        params.update(build_qs([
-            rev_search_options[x] if type(x) != int else x for x in params['forcedisplay']
-        ], 'forcedisplay'))
-        del params['forcedisplay']
+        forcedisplay = tuple(params.pop('forcedisplay'))
+        key = (itemtype, forcedisplay)
+        if itemtype_options and key in glpi._forcedisplay_cache:
+            forcedisplay = glpi._forcedisplay_cache[key]
+        else:
+            forcedisplay = tuple(
+                x if isinstance(x, int) else rev_search_options[x]
+                for x in forcedisplay
+            )
+            # only the search options of the itemtype itself are cached
+            if itemtype_options:
+                glpi._forcedisplay_cache[key] = forcedisplay
+        params.update(
+            (f'forcedisplay[{i}]', x) for i, x in enumerate(forcedisplay)
+        )
 
-    result = glpi.search(itemtype).GET(params=params)
+    result = glpi.search(itemtype).GET(params=params, stream=stream)
     result.raise_for_status()
-    prefix_re = re.compile(r'^[^\.]+\.')
-    for r in result.ranges:
-        for it in r.json().get('data', ()):
-            yield {
-                prefix_re.sub('', search_options.get(k, {}).get('uid', k)): v
-                for k, v in it.items()
-            }
+    keys = None
+    # close the ranges and responses also if the caller stops early, to
+    # release the connections of streamed responses
+    with closing(result.ranges) as ranges:
+        for r in ranges:
+            with r:
+                if stream:
+                    r.raw.decode_content = True
+                    rows = ijson.items(r.raw, 'data.item', use_float=True)
+                else:
+                    rows = _loads(r.content).get('data', ())
+                for it in rows:
+                    # rows usually share their keys, so only translate them on
+                    # change
+                    if tuple(it) != keys:
+                        keys = tuple(it)
+                        translated = [
+                            key_map[k] if k in key_map
+                            else key_map.setdefault(k, _strip_prefix(k))
+                            for k in keys
+                        ]
+                    yield dict(zip(translated, it.values()))
 
 
 class GLPI(Hammock):
@@ -180,9 +427,17 @@ class GLPI(Hammock):
     >>> computers = []
     >>> for r in glpi.Computer.GET().ranges:
     ...     computers.extend(r.json())  # doctest:+SKIP
+
+    Ranges after the first one are requested with `_range_length` items each,
+    which can be overridden per instance via the environment variable
+    ``GLPI_RANGE_LENGTH`` or per request via ``GET(range_length=...)``. Larger
+    ranges need fewer round-trips but increase the size of each response.
+    Up to `_range_workers` ranges are fetched ahead in parallel while the
+    previous ones are processed.
     """
 
-    _range_length = None
+    _range_length = 1000
+    _range_workers = 4
 
     def __init__(
             self,
@@ -213,8 +468,18 @@ class GLPI(Hammock):
             'Content-Type': 'application/json',
         })
 
+        if ENVVARS['range_length'] in os.environ:
+            self._range_length = _parse_range_length(
+                os.environ[ENVVARS['range_length']],
+                ENVVARS['range_length'],
+            )
+
+        self._search_options_cache = {}
+        self._reverse_cache = {}
+        self._forcedisplay_cache = {}
+
         if credentials:
-            self._login('Basic %s' % b64encode(':'.join(credentials)))
+            self._login(_basic_auth(credentials))
         elif user_token:
             self._login('user_token %s' % user_token)
         else:
@@ -231,7 +496,7 @@ class GLPI(Hammock):
         response = self.initSession.GET(headers={'Authorization': auth})
 
         try:
-            data = response.json()
+            data = _loads(response.content)
             token = data['session_token']
         except ValueError:
             # decoding JSON failed
@@ -242,48 +507,97 @@ class GLPI(Hammock):
         else:
             self._session.headers['Session-Token'] = token
 
-    def _request(self, *args, **kwargs):
-        response = super()._request(*args, **kwargs)
+    def _check_response(self, response):
         if not response.ok:
             try:
-                raise APIError(response.request.url, *response.json())
+                raise APIError(response.request.url, *_loads(response.content))
             except ValueError:
                 response.raise_for_status()
+
+    def _request(self, *args, **kwargs):
+        response = super()._request(*args, **kwargs)
+        self._check_response(response)
         return response
 
-    def _rangeiter(self, response):
+    def _fetch_range(self, request, url, start, end, stream=False):
+        # the query of the first request never contains a range, so the range
+        # can simply be appended
+        query = f'range={start}-{end}'
+        if url.query:
+            query = f'{url.query}&{query}'
+        request = request.copy()
+        request.url = urlunparse(url._replace(query=query))
+        return self._session.send(request, stream=stream)
+
+    def _rangeiter(self, response, range_length=None, stream=False):
         yield response
 
         if response.status_code != 206:
             return
 
-        if 'range' in parse_qs(urlparse(response.request.url).query):
+        url = urlparse(response.request.url)
+        if 'range' in parse_qs(url.query, keep_blank_values=True):
             return
 
-        while True:
-            currange = re.match(
-                r'^(?P<start>\d+)-(?P<end>\d+)/(?P<total>\d+)$',
-                response.headers['Content-Range']
-            )
-            start, end, total = (
-                int(currange.group(x)) for x in ('start', 'end', 'total')
-            )
-
-            if end == total - 1:
-                break
-
-            length = self._range_length or end - start + 1
-            start = end + 1
-            end += length
+        start, end, total = _content_range(response)
+        length = range_length or self._range_length or end - start + 1
+        request = response.request
 
-            url = urlparse(response.request.url)
-            args = parse_qs(url.query, keep_blank_values=True)
-            args['range'] = '{}-{}'.format(start, min(end, total))
-            response.request.url = urlunparse(url._replace(query=urlencode(args, True)))
-            response = self._session.send(response.request)
-            yield response
+        def fetch(start, end):
+            return self._fetch_range(request, url, start, end, stream=stream)
 
-    def GET(self, *args, **kwargs):
+        executor = ThreadPoolExecutor(self._range_workers)
+        window = deque()
+        start = end + 1
+        try:
+            while True:
+                # keep up to _range_workers ranges in flight, according to the
+                # total of the latest response
+                while len(window) < self._range_workers and start < total:
+                    end = min(start + length, total) - 1
+                    window.append((start, end, executor.submit(fetch, start, end)))
+                    start = end + 1
+
+                if not window:
+                    break
+
+                rstart, rend, future = window.popleft()
+                if rstart >= total:
+                    # items were deleted since the range was requested
+                    _discard(future)
+                    continue
+
+                response = future.result()
+                while True:
+                    self._check_response(response)
+                    got_start, got, total = _content_range(response)
+                    if got_start != rstart or got < rstart:
+                        response.close()
+                        raise RuntimeError(
+                            'GLPI returned range %d-%d instead of %d-%d' % (
+                                got_start, got, rstart, rend,
+                            )
+                        )
+                    yield response
+
+                    # the server may return less items than requested
+                    rend = min(rend, total - 1)
+                    if got >= rend:
+                        break
+                    rstart = got + 1
+                    response = fetch(rstart, rend)
+        finally:
+            for _, _, future in window:
+                _discard(future)
+            executor.shutdown(wait=False)
+
+    def GET(self, *args, range_length=None, **kwargs):
+        if range_length is not None:
+            range_length = _parse_range_length(range_length, 'range_length')
         response = super().GET(*args, **kwargs)
-        response.ranges = self._rangeiter(response)
+        response.ranges = self._rangeiter(
+            response,
+            range_length,
+            kwargs.get('stream', False),
+        )
         return response
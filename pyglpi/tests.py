@@ -1,5 +1,14 @@
+import io
+import json
+import os
+import threading
+import time
 import unittest
+import unittest.mock
 import doctest
+from urllib.parse import urlparse, parse_qs
+
+from requests import PreparedRequest, Response
 
 import pyglpi
 
@@ -9,5 +18,266 @@ def load_tests(loader, tests, ignore):
     return tests
 
 
+class FakeSession:
+    """
+    Stub for the requests session of `GLPI` serving a list of items in ranges
+    """
+
+    def __init__(self, total, default_length=50, max_length=None,
+                 search=False, search_options=None):
+        self.items = list(range(total))
+        self.search = search
+        self.search_options = search_options
+        self.default_length = default_length
+        self.max_length = max_length
+        self.requests = []
+        self.open = 0
+        self.before_send = None
+        self._lock = threading.Lock()
+
+    def send(self, request, stream=False):
+        with self._lock:
+            self.requests.append(request.url)
+            if self.before_send:
+                self.before_send(self, request)
+            items = list(self.items)
+            self.open += 1
+
+        response = Response()
+        response.request = request
+        response.url = request.url
+        response.close = self._close
+        if '/listSearchOptions/' in request.url:
+            response.status_code = 200
+            response._content = json.dumps(self.search_options).encode()
+            return response
+
+        total = len(items)
+        try:
+            start, end = map(
+                int,
+                parse_qs(urlparse(request.url).query)['range'][0].split('-'),
+            )
+        except KeyError:
+            start, end = 0, self.default_length - 1
+        if self.max_length:
+            end = min(end, start + self.max_length - 1)
+        end = min(end, total - 1)
+
+        if start >= total:
+            response.status_code = 400
+            body = [
+                'ERROR_RANGE_EXCEED_TOTAL',
+                'Provided range exceed total count of data: %d' % total,
+            ]
+        else:
+            response.status_code = 206 if end - start + 1 < total else 200
+            response.headers['Content-Range'] = '%d-%d/%d' % (start, end, total)
+            body = items[start:end + 1]
+            if self.search:
+                key = '2'
+                if 'uid_cols=true' in request.url:
+                    key = 'Computer.id'
+                body = {'data': [{key: it} for it in body]}
+        response._content = json.dumps(body).encode()
+        if stream:
+            response.raw = io.BytesIO(response._content)
+            response._content = False
+        return response
+
+    def request(self, method, url, params=None, **kwargs):
+        request = PreparedRequest()
+        request.prepare(method, url, params=params)
+        return self.send(request, **kwargs)
+
+    def _close(self):
+        with self._lock:
+            self.open -= 1
+
+
+class RangeIterTest(unittest.TestCase):
+    def setUp(self):
+        self.glpi = pyglpi.GLPI('http://glpi.example.org/apirest.php', 'app')
+
+    def ranges(self, session, range_length=50):
+        self.glpi._session = session
+        request = PreparedRequest()
+        request.prepare('GET', 'http://glpi.example.org/apirest.php/Computer')
+        return self.glpi._rangeiter(session.send(request), range_length)
+
+    def items(self, ranges):
+        items = []
+        for r in ranges:
+            items.extend(json.loads(r.content))
+            r.close()
+        return items
+
+    def test_invalid_range_length(self):
+        for value in ('-100', '0', 'many'):
+            with unittest.mock.patch.dict(
+                os.environ, {'GLPI_RANGE_LENGTH': value},
+            ):
+                with self.assertRaises(RuntimeError):
+                    pyglpi.GLPI('http://glpi.example.org/apirest.php', 'app')
+        with self.assertRaises(RuntimeError):
+            self.glpi.Computer.GET(range_length=0)
+
+    def test_all_items(self):
+        session = FakeSession(250)
+        self.assertEqual(self.items(self.ranges(session)), list(range(250)))
+        self.assertEqual(len(session.requests), 5)
+
+    def test_bounded_read_ahead(self):
+        session = FakeSession(5050)
+        ranges = self.ranges(session)
+        next(ranges)
+        next(ranges)
+        self.assertLessEqual(
+            len(session.requests), 1 + self.glpi._range_workers
+        )
+        ranges.close()
+
+    def test_short_ranges(self):
+        session = FakeSession(250, max_length=30)
+        self.assertEqual(self.items(self.ranges(session)), list(range(250)))
+
+    def test_shrinking_total(self):
+        def delete_items(session, request):
+            if 'range=100-' in request.url:
+                del session.items[130:]
+
+        session = FakeSession(250)
+        session.before_send = delete_items
+        self.assertEqual(self.items(self.ranges(session)), list(range(130)))
+
+    def test_growing_total(self):
+        def add_items(session, request):
+            if 'range=100-' in request.url:
+                session.items.extend(range(250, 270))
+
+        session = FakeSession(250)
+        session.before_send = add_items
+        self.assertEqual(self.items(self.ranges(session)), list(range(270)))
+
+    def test_no_progress(self):
+        session = FakeSession(250)
+        ranges = self.ranges(session)
+        next(ranges)
+
+        def stuck(request, stream=False):
+            response = FakeSession.send(session, request)
+            response.headers['Content-Range'] = '0-49/250'
+            return response
+
+        session.send = stuck
+        with self.assertRaises(RuntimeError):
+            next(ranges)
+
+    def test_api_error(self):
+        session = FakeSession(250)
+        ranges = self.ranges(session)
+        next(ranges)
+
+        def error(request, stream=False):
+            response = FakeSession.send(session, request)
+            response.status_code = 500
+            response._content = b'["ERROR", "Something went wrong"]'
+            return response
+
+        session.send = error
+        with self.assertRaises(pyglpi.APIError):
+            next(ranges)
+
+
+class SearchTest(unittest.TestCase):
+    search_options = {
+        '1': {'uid': 'Computer.name'},
+        '2': {'uid': 'Computer.id'},
+    }
+
+    def setUp(self):
+        self.glpi = pyglpi.GLPI('http://glpi.example.org/apirest.php', 'app')
+
+    def test_search(self):
+        self.glpi._session = FakeSession(250, search=True)
+        result = pyglpi.search(self.glpi, 'Computer', [], self.search_options)
+        self.assertEqual([it['id'] for it in result], list(range(250)))
+
+    def test_passed_search_options_not_cached(self):
+        self.glpi._session = FakeSession(10, search=True)
+        search_options = dict(self.search_options)
+        list(pyglpi.search(self.glpi, 'Computer', [], search_options))
+        search_options['1'] = {'uid': 'Computer.name'}
+        criteria = [{'field': 'name', 'value': 'foo'}]
+        result = pyglpi.search(self.glpi, 'Computer', criteria, search_options)
+        self.assertEqual(len(list(result)), 10)
+        self.assertEqual(self.glpi._reverse_cache, {})
+
+    def test_forcedisplay_not_cached_for_passed_search_options(self):
+        session = self.glpi._session = FakeSession(10, search=True)
+        result = pyglpi.search(
+            self.glpi, 'Computer', [], self.search_options, forcedisplay=['id'],
+        )
+        self.assertEqual(len(list(result)), 10)
+        self.assertIn('forcedisplay%5B0%5D=2', session.requests[0])
+        self.assertEqual(self.glpi._forcedisplay_cache, {})
+
+    def test_search_options_fetched_once(self):
+        session = self.glpi._session = FakeSession(
+            10, search=True, search_options=self.search_options,
+        )
+        for _ in range(2):
+            result = pyglpi.search(self.glpi, 'Computer', [])
+            self.assertEqual([it['id'] for it in result], list(range(10)))
+        self.assertEqual(
+            sum('/listSearchOptions/' in url for url in session.requests), 1
+        )
+
+    def test_lazy_search_options_numeric_fields(self):
+        session = self.glpi._session = FakeSession(
+            10, search=True, search_options=self.search_options,
+        )
+        criteria = [{'field': 1, 'searchtype': 'contains', 'value': 'foo'}]
+        result = pyglpi.search(
+            self.glpi, 'Computer', criteria, 'lazy', forcedisplay=[2],
+        )
+        self.assertEqual(list(result), [{'id': i} for i in range(10)])
+        self.assertFalse(
+            any('/listSearchOptions/' in url for url in session.requests)
+        )
+        self.assertIn('uid_cols=true', session.requests[0])
+
+    def test_lazy_search_options_uid_fields(self):
+        session = self.glpi._session = FakeSession(
+            10, search=True, search_options=self.search_options,
+        )
+        criteria = [{'field': 'name', 'searchtype': 'contains', 'value': 'foo'}]
+        for _ in range(2):
+            result = pyglpi.search(self.glpi, 'Computer', criteria, 'lazy')
+            self.assertEqual(list(result), [{'id': i} for i in range(10)])
+        self.assertEqual(
+            sum('/listSearchOptions/' in url for url in session.requests), 1
+        )
+        self.assertIn('criteria%5B0%5D%5Bfield%5D=1', session.requests[-1])
+
+    @unittest.skipIf(pyglpi.ijson is None, 'ijson is not installed')
+    def test_stream_closes_responses(self):
+        session = self.glpi._session = FakeSession(5050, search=True)
+        result = pyglpi.search(
+            self.glpi, 'Computer', [], self.search_options, stream=True,
+        )
+        self.assertEqual(next(result), {'id': 0})
+        result.close()
+        self.assertLessEqual(
+            len(session.requests), 1 + self.glpi._range_workers
+        )
+        # responses fetched ahead are closed once they are received
+        for _ in range(100):
+            if not session.open:
+                break
+            time.sleep(0.01)
+        self.assertEqual(session.open, 0)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -8,8 +8,13 @@ setup(
     author_email='jpl@plutex.de',
     license='BSD-2',
     packages=['pyglpi'],
+    python_requires='>=3.6',
     install_requires=[
         'hammock',
     ],
+    extras_require={
+        'orjson': ['orjson'],
+        'ijson': ['ijson>=3.1'],
+    },
     testsuite='pyglpi.tests',
 )